@@ -1,70 +1,198 @@
+import asyncio
+import gzip
+import logging
 import os
-import json
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from urllib.parse import urljoin
 
-import requests
+import httpx
+import orjson
 
 # ====== CONFIG (from environment) ======
 
 BASE_URL = "https://cavaathleisure.com"
+PRODUCT_URL_PREFIX = f"{BASE_URL}/products/"
 
 SMTP_SERVER = os.getenv("SMTP_SERVER", "smtp.gmail.com")
 SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
-SMTP_USER = os.getenv("SMTP_USER")          # FROM email
-SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")  # SMTP / app password
-TO_EMAIL = os.getenv("TO_EMAIL", SMTP_USER) # Default TO == FROM if not set
+SMTP_USER = os.getenv("SMTP_USER", "")          # FROM email
+SMTP_PASSWORD = os.getenv("SMTP_PASSWORD", "")  # SMTP / app password
+TO_EMAIL = os.getenv("TO_EMAIL", SMTP_USER)     # Default TO == FROM if not set
 
 # Email only if there is ANY change compared to previous day
 ONLY_EMAIL_IF_CHANGES = os.getenv("ONLY_EMAIL_IF_CHANGES", "true").lower() == "true"
 
-STATE_FILE = "state.json"  # stored in repo to compare day-to-day
+STATE_FILE = "state.json"        # legacy uncompressed snapshot (read-only fallback)
+STATE_FILE_GZ = "state.json.gz"  # stored in repo to compare day-to-day
+
+# Per-product/per-page chatter lives at DEBUG; set LOG_LEVEL=DEBUG to see it.
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(message)s")
+# httpx logs every request at INFO, which would reintroduce per-page lines.
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
 
 
 # ====== HTTP HELPERS ======
 
-def fetch_products_page(page: int, limit: int = 250):
+HTTP_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (compatible; CavaStockBot/1.0)",
+    "Accept": "application/json",
+    # Advertise compression explicitly so the CDN never falls back to
+    # serving the JSON uncompressed (it squeezes ~8-12x).
+    "Accept-Encoding": "br, gzip",
+}
+
+# How many pages to request concurrently per batch.
+PAGE_CONCURRENCY = 8
+
+# Shopify's maximum page size; a shorter page means the catalog is exhausted.
+PAGE_LIMIT = 250
+
+# Transient statuses worth retrying with backoff. The httpx transport only
+# retries connect errors, so throttling/5xx handling lives here.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RETRY_TOTAL = 3
+RETRY_BACKOFF = 0.3
+
+# Side-car cache of per-page ETags plus the matching product lists, so an
+# unchanged page costs a headers-only 304 instead of a full body download.
+PAGES_CACHE_FILE = "pages_cache.json.gz"
+
+
+def load_pages_cache() -> dict[str, dict]:
+    """
+    Load the page cache: {"etags": {page: etag}, "pages": {page: [products]}}.
+    Page numbers are stored as strings (JSON object keys).
+    """
+    if not os.path.exists(PAGES_CACHE_FILE):
+        return {"etags": {}, "pages": {}}
+
+    try:
+        with gzip.open(PAGES_CACHE_FILE, "rb") as f:
+            data = orjson.loads(f.read())
+        return {"etags": data.get("etags", {}), "pages": data.get("pages", {})}
+    except Exception as e:
+        logger.warning("Could not read %s: %s", PAGES_CACHE_FILE, e)
+        return {"etags": {}, "pages": {}}
+
+
+def save_pages_cache(cache: dict[str, dict]) -> None:
+    # mtime=0 keeps the gzip header deterministic, so unchanged content
+    # produces byte-identical files and the workflow's diff gate holds.
+    with gzip.GzipFile(PAGES_CACHE_FILE, "wb", compresslevel=6, mtime=0) as f:
+        f.write(orjson.dumps(cache))
+
+
+async def fetch_products_page(client: httpx.AsyncClient, page: int, cache: dict[str, dict],
+                              limit: int = PAGE_LIMIT) -> list[dict]:
     """
     Fetch a single page of products from Shopify /products.json.
     Returns list of products or [] if none.
+
+    Sends If-None-Match when the page was seen before; on 304 Not
+    Modified the cached product list is returned without a body download.
     """
-    url = f"{BASE_URL}/products.json?limit={limit}&page={page}"
-    headers = {
-        "User-Agent": "Mozilla/5.0 (compatible; CavaStockBot/1.0)",
-        "Accept": "application/json",
-    }
-    resp = requests.get(url, headers=headers, timeout=30)
+    # Only request the fields the report actually reads; the full payload
+    # (images, body_html, options, ...) is an order of magnitude larger.
+    url = f"{BASE_URL}/products.json?limit={limit}&page={page}&fields=title,handle,variants"
+    key = str(page)
+
+    # Only revalidate when we also still have the body the ETag describes.
+    headers = {}
+    etag = cache["etags"].get(key)
+    if etag and key in cache["pages"]:
+        headers["If-None-Match"] = etag
+
+    for attempt in range(RETRY_TOTAL + 1):
+        resp = await client.get(url, headers=headers, timeout=30)
+        if resp.status_code not in RETRY_STATUSES or attempt == RETRY_TOTAL:
+            break
+        await resp.aclose()
+        delay = RETRY_BACKOFF * (2 ** attempt)
+        logger.debug("Got status %s for page %d, retrying in %.1fs", resp.status_code, page, delay)
+        await asyncio.sleep(delay)
+
+    if page == 1:
+        logger.debug("Content-Encoding from CDN: %s", resp.headers.get("Content-Encoding", "none"))
+    if resp.status_code == 304:
+        logger.debug("Page %d not modified, using cached products", page)
+        await resp.aclose()
+        return cache["pages"][key]
     if resp.status_code != 200:
-        print(f"Got status {resp.status_code} for {url}, stopping pagination.")
-        return []
-    data = resp.json()
-    return data.get("products", [])
-
-
-def fetch_all_products():
+        # Raise rather than return []: an empty page means end-of-catalog
+        # to the caller, and a throttled run must not persist a truncated
+        # snapshot (which would trigger a false mass-removal email).
+        await resp.aclose()
+        raise RuntimeError(f"Got status {resp.status_code} for {url} after retries.")
+    # Pull out just the products and close the response so the raw body
+    # bytes are freed immediately, not alongside the decoded page.
+    products = orjson.loads(resp.content).get("products", [])
+    await resp.aclose()
+
+    new_etag = resp.headers.get("ETag")
+    if new_etag and products:
+        cache["etags"][key] = new_etag
+        cache["pages"][key] = products
+    return products
+
+
+async def fetch_all_products_async() -> list[dict]:
     """
     Fetch all products across all /products.json pages.
+
+    Pages are requested in concurrent batches over a single HTTP/2
+    connection, so total wall time is bounded by the slowest page in a
+    batch rather than the sum of all page round-trips.
     """
     all_products = []
     page = 1
+    cache = load_pages_cache()
+
+    transport = httpx.AsyncHTTPTransport(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=8, max_connections=8),
+        retries=3,
+    )
+    async with httpx.AsyncClient(transport=transport, headers=HTTP_HEADERS) as client:
+        while True:
+            batch = range(page, page + PAGE_CONCURRENCY)
+            results = await asyncio.gather(
+                *(fetch_products_page(client, p, cache) for p in batch)
+            )
+
+            done = False
+            for p, products in zip(batch, results):
+                if not products:
+                    done = True
+                    break
+                all_products.extend(products)
+                logger.debug("Fetched %d products from page %d", len(products), p)
+                if len(products) < PAGE_LIMIT:
+                    # Short page: the catalog ends here, no need to ask
+                    # for another batch just to see it come back empty.
+                    done = True
+                    break
+
+            if done:
+                break
+            page += PAGE_CONCURRENCY
+
+    save_pages_cache(cache)
+    logger.info("Total products fetched: %d", len(all_products))
+    return all_products
 
-    while True:
-        products = fetch_products_page(page)
-        if not products:
-            break
-        all_products.extend(products)
-        print(f"Fetched {len(products)} products from page {page}")
-        page += 1
 
-    print(f"Total products fetched: {len(all_products)}")
-    return all_products
+def fetch_all_products() -> list[dict]:
+    """
+    Fetch all products across all /products.json pages.
+    """
+    return asyncio.run(fetch_all_products_async())
 
 
 # ====== BUILD REPORT FROM PRODUCTS.JSON ======
 
-def build_report_via_products_json():
+def build_report_via_products_json() -> tuple[dict[str, dict], dict[str, str]]:
     """
     Build a report mapping, with three buckets:
 
@@ -80,10 +208,14 @@ def build_report_via_products_json():
       "full_in_stock": { ... },
       "full_oos": { ... }
     }
+
+    Returns (report, state); the state fingerprints are built in the same
+    pass so the products are only walked once.
     """
     partial = {}
     full_in_stock = {}
     full_oos = {}
+    state = {}
 
     products = fetch_all_products()
 
@@ -93,10 +225,10 @@ def build_report_via_products_json():
         if not handle:
             continue
 
-        product_url = urljoin(BASE_URL, f"/products/{handle}")
+        product_url = PRODUCT_URL_PREFIX + handle
 
-        available_sizes = []
-        unavailable_sizes = []
+        avail = set()
+        unavail = set()
         total_variants_with_size = 0
 
         for v in p.get("variants", []):
@@ -106,97 +238,89 @@ def build_report_via_products_json():
                 continue
             total_variants_with_size += 1
             if available:
-                available_sizes.append(size)
+                avail.add(size)
             else:
-                unavailable_sizes.append(size)
+                unavail.add(size)
 
         if total_variants_with_size == 0:
             # No meaningful size info; skip
             continue
 
-        unique_available = sorted(set(available_sizes))
-        unique_unavailable = sorted(set(unavailable_sizes))
-
-        # Classify product
-        if unique_available and unique_unavailable:
+        # Classify on set truthiness first and sort only the side(s) the
+        # winning bucket needs — fully available / fully OOS products
+        # (usually the majority) skip one sort entirely.
+        if avail and unavail:
             # Partially sold out
+            status_key = "partial"
+            unique_available = sorted(avail)
+            unique_unavailable = sorted(unavail)
             partial[product_url] = {
                 "title": title,
                 "available_sizes": unique_available,
                 "unavailable_sizes": unique_unavailable,
             }
-            print(f"[PARTIAL OOS] {title} -> OOS: {', '.join(unique_unavailable)} | IN STOCK: {', '.join(unique_available)}")
-        elif unique_available and not unique_unavailable:
+            logger.debug("[PARTIAL OOS] %s -> OOS: %s | IN STOCK: %s", title, ", ".join(unique_unavailable), ", ".join(unique_available))
+        elif avail:
             # Fully available
+            status_key = "full_in_stock"
+            unique_available = sorted(avail)
+            unique_unavailable = []
             full_in_stock[product_url] = {
                 "title": title,
                 "available_sizes": unique_available,
                 "unavailable_sizes": [],
             }
-            print(f"[FULL IN STOCK] {title} -> {', '.join(unique_available)}")
-        elif unique_unavailable and not unique_available:
+            logger.debug("[FULL IN STOCK] %s -> %s", title, ", ".join(unique_available))
+        elif unavail:
             # Fully sold out
+            status_key = "full_oos"
+            unique_available = []
+            unique_unavailable = sorted(unavail)
             full_oos[product_url] = {
                 "title": title,
                 "available_sizes": [],
                 "unavailable_sizes": unique_unavailable,
             }
-            print(f"[FULL OOS] {title} -> ALL SIZES OOS: {', '.join(unique_unavailable)}")
+            logger.debug("[FULL OOS] %s -> ALL SIZES OOS: %s", title, ", ".join(unique_unavailable))
         else:
             # Weird edge case
             continue
 
-    return {
+        state[product_url] = product_fingerprint(
+            status_key, unique_available, unique_unavailable
+        )
+
+    report = {
         "partial": partial,
         "full_in_stock": full_in_stock,
         "full_oos": full_oos,
     }
+    return report, state
 
 
 # ====== HTML & TEXT REPORT FORMATTERS ======
 
-def render_table_html(title, items, status):
-    """
-    status = 'partial' | 'full_in_stock' | 'full_oos'
-    """
-    if status == "partial":
-        header_color = "#ffb347"  # orange-ish
-    elif status == "full_in_stock":
-        header_color = "#77dd77"  # green-ish
-    else:
-        header_color = "#ff6961"  # red-ish
-
-    if not items:
-        return f"""
+HEADER_COLORS = {
+    "partial": "#ffb347",        # orange-ish
+    "full_in_stock": "#77dd77",  # green-ish
+    "full_oos": "#ff6961",       # red-ish
+}
+
+STATUS_LABELS = {
+    "partial": "Partially Sold-Out",
+    "full_in_stock": "Fully Available",
+    "full_oos": "Fully Sold-Out",
+}
+
+# Templates built once at import; the static chrome (headers, inline CSS,
+# page shell) is encoded into these constants and only the dynamic values
+# are substituted with .format() at run time.
+EMPTY_TABLE_TMPL = """
         <h2>{title}</h2>
         <p style="color:#666;">None.</p>
         """
 
-    rows_html = ""
-    for url, data in items.items():
-        name = data["title"]
-        available = ", ".join(data["available_sizes"]) if data["available_sizes"] else "None"
-        unavailable = ", ".join(data["unavailable_sizes"]) if data["unavailable_sizes"] else "None"
-
-        if status == "partial":
-            status_label = "Partially Sold-Out"
-        elif status == "full_in_stock":
-            status_label = "Fully Available"
-        else:
-            status_label = "Fully Sold-Out"
-
-        rows_html += f"""
-        <tr>
-            <td style="padding:8px; border:1px solid #ddd; font-weight:500;">
-                <a href="{url}" style="color:#1a73e8; text-decoration:none;">{name}</a>
-            </td>
-            <td style="padding:8px; border:1px solid #ddd;">{status_label}</td>
-            <td style="padding:8px; border:1px solid #ddd;">{available}</td>
-            <td style="padding:8px; border:1px solid #ddd;">{unavailable}</td>
-        </tr>
-        """
-
-    return f"""
+TABLE_HEAD_TMPL = """
     <h2 style="margin-top:24px; margin-bottom:8px;">{title}</h2>
     <table cellpadding="0" cellspacing="0" style="border-collapse:collapse; width:100%; max-width:900px; font-size:14px;">
         <thead>
@@ -208,22 +332,14 @@ def render_table_html(title, items, status):
             </tr>
         </thead>
         <tbody>
-            {rows_html}
+    """
+
+TABLE_FOOT = """
         </tbody>
     </table>
     """
 
-
-def format_report_html(report):
-    partial = report.get("partial", {})
-    full_in_stock = report.get("full_in_stock", {})
-    full_oos = report.get("full_oos", {})
-
-    partial_html = render_table_html("1) Partially Sold-Out Products", partial, "partial")
-    full_in_stock_html = render_table_html("2) Fully Available Products", full_in_stock, "full_in_stock")
-    full_oos_html = render_table_html("3) Fully Sold-Out Products", full_oos, "full_oos")
-
-    html = f"""
+HTML_HEAD = """
     <html>
     <head>
       <meta charset="UTF-8" />
@@ -233,9 +349,9 @@ def format_report_html(report):
       <div style="max-width:960px; margin:0 auto; background:#ffffff; padding:16px 24px; border-radius:8px; box-shadow:0 2px 4px rgba(0,0,0,0.08);">
         <h1 style="font-size:20px; margin-bottom:4px;">CAVA Daily Stock Report</h1>
         <p style="margin-top:0; color:#666; font-size:13px;">Source: /products.json • Generated automatically</p>
-        {partial_html}
-        {full_in_stock_html}
-        {full_oos_html}
+    """
+
+HTML_FOOT = """
         <p style="margin-top:24px; font-size:11px; color:#999;">
           This email was generated by an automated GitHub Actions job.
         </p>
@@ -243,10 +359,60 @@ def format_report_html(report):
     </body>
     </html>
     """
-    return html
 
+ROW_TMPL = """
+        <tr>
+            <td style="padding:8px; border:1px solid #ddd; font-weight:500;">
+                <a href="{url}" style="color:#1a73e8; text-decoration:none;">{name}</a>
+            </td>
+            <td style="padding:8px; border:1px solid #ddd;">{status_label}</td>
+            <td style="padding:8px; border:1px solid #ddd;">{available}</td>
+            <td style="padding:8px; border:1px solid #ddd;">{unavailable}</td>
+        </tr>
+        """
+
+
+def render_table_html(title: str, items: dict[str, dict], status: str) -> str:
+    """
+    status = 'partial' | 'full_in_stock' | 'full_oos'
+    """
+    header_color = HEADER_COLORS[status]
+    status_label = STATUS_LABELS[status]
+
+    if not items:
+        return EMPTY_TABLE_TMPL.format(title=title)
+
+    # One join over head + rows + foot builds the table in a single
+    # allocation instead of copying the rows buffer into a shell template.
+    parts = [TABLE_HEAD_TMPL.format(title=title, header_color=header_color)]
+    for url, data in items.items():
+        parts.append(ROW_TMPL.format(
+            url=url,
+            name=data["title"],
+            status_label=status_label,
+            available=", ".join(data["available_sizes"]) or "None",
+            unavailable=", ".join(data["unavailable_sizes"]) or "None",
+        ))
+    parts.append(TABLE_FOOT)
+
+    return "".join(parts)
 
-def format_report_text(report):
+
+def format_report_html(report: dict[str, dict]) -> str:
+    partial = report.get("partial", {})
+    full_in_stock = report.get("full_in_stock", {})
+    full_oos = report.get("full_oos", {})
+
+    return "".join([
+        HTML_HEAD,
+        render_table_html("1) Partially Sold-Out Products", partial, "partial"),
+        render_table_html("2) Fully Available Products", full_in_stock, "full_in_stock"),
+        render_table_html("3) Fully Sold-Out Products", full_oos, "full_oos"),
+        HTML_FOOT,
+    ])
+
+
+def format_report_text(report: dict[str, dict]) -> str:
     """
     Simple plain-text fallback for email clients that don't support HTML.
     """
@@ -300,81 +466,110 @@ def format_report_text(report):
 
 # ====== STATE / DIFF LOGIC ======
 
-def load_previous_state():
+def product_fingerprint(status: str, available: list[str], unavailable: list[str]) -> str:
+    """
+    Collapse one product's availability into a single comparable string:
+    "<status>|<size>|<size>#<size>|<size>". Sizes are already sorted
+    upstream, so equal availability always yields an identical string.
+    """
+    return f"{status}|{'|'.join(available)}#{'|'.join(unavailable)}"
+
+
+def load_previous_state() -> dict[str, str]:
     """
-    Load previous snapshot from state.json.
+    Load previous snapshot from state.json.gz (or the legacy state.json
+    if the compressed file does not exist yet).
     Format:
     {
       "products": {
-        "<product_url>": {
-          "status": "partial" | "full_in_stock" | "full_oos",
-          "available": [...],
-          "unavailable": [...]
-        },
+        "<product_url>": "<status>|<available sizes>#<unavailable sizes>",
         ...
       }
     }
     """
-    if not os.path.exists(STATE_FILE):
-        return {}
-
     try:
-        with open(STATE_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        return data.get("products", {})
+        if os.path.exists(STATE_FILE_GZ):
+            with gzip.open(STATE_FILE_GZ, "rb") as f:
+                data = orjson.loads(f.read())
+        elif os.path.exists(STATE_FILE):
+            with open(STATE_FILE, "rb") as f:
+                data = orjson.loads(f.read())
+        else:
+            return {}
+        products = data.get("products", {})
     except Exception as e:
-        print(f"Could not read {STATE_FILE}: {e}")
+        logger.warning("Could not read state file: %s", e)
         return {}
 
+    # Migrate entries from the old schema, where each product was a dict
+    # of {"status": ..., "available": [...], "unavailable": [...]}.
+    for url, entry in products.items():
+        if isinstance(entry, dict):
+            products[url] = product_fingerprint(
+                entry.get("status", ""),
+                entry.get("available", []),
+                entry.get("unavailable", []),
+            )
+    return products
 
-def save_current_state(current_state):
+
+def save_current_state(current_state: dict[str, str]) -> None:
     """
-    Save current snapshot to state.json.
+    Save current snapshot to state.json.gz, compact and gzipped.
     """
     data = {"products": current_state}
-    with open(STATE_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    # mtime=0: see save_pages_cache — identical content must yield
+    # identical bytes or every run commits a fresh blob.
+    with gzip.GzipFile(STATE_FILE_GZ, "wb", compresslevel=6, mtime=0) as f:
+        f.write(orjson.dumps(data))
 
 
-def extract_state_from_report(report):
+def diff_states(prev_state: dict[str, str], curr_state: dict[str, str]) -> tuple[set[str], set[str], set[str]]:
     """
-    Convert report format to simple state:
-    {
-      product_url: {
-        "status": "partial" | "full_in_stock" | "full_oos",
-        "available": [...],
-        "unavailable": [...]
-      }
-    }
-    """
-    state = {}
-    for status_key in ("partial", "full_in_stock", "full_oos"):
-        bucket = report.get(status_key, {})
-        for url, data in bucket.items():
-            state[url] = {
-                "status": status_key,
-                "available": list(data.get("available_sizes", [])),
-                "unavailable": list(data.get("unavailable_sizes", [])),
-            }
-    return state
-
+    Compare previous and current states in one pass.
 
-def has_changes(prev_state, curr_state):
+    Returns (added, removed, changed) — sets of product URLs that are new,
+    gone, or whose availability differs since the last run.
     """
-    Return True if there is any change between previous and current states.
-    """
-    return prev_state != curr_state
+    added = curr_state.keys() - prev_state.keys()
+    removed = prev_state.keys() - curr_state.keys()
+    changed = {
+        url for url in curr_state.keys() & prev_state.keys()
+        if curr_state[url] != prev_state[url]
+    }
+    return added, removed, changed
 
 
 # ====== EMAIL SENDING ======
 
-def send_email(subject: str, html_body: str, text_body: str | None = None):
+def open_smtp() -> smtplib.SMTP:
+    """
+    Connect, STARTTLS and log in to the SMTP server.
+
+    The returned connection doubles as a context manager; keeping it open
+    across several send_email calls shares one TLS handshake + AUTH
+    instead of reconnecting per message.
+    """
     if not SMTP_USER or not SMTP_PASSWORD:
         raise RuntimeError("SMTP_USER and SMTP_PASSWORD must be set in environment variables.")
 
+    server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
+    try:
+        server.starttls()
+        server.login(SMTP_USER, SMTP_PASSWORD)
+    except Exception:
+        server.close()
+        raise
+    return server
+
+
+def send_email(server: smtplib.SMTP, subject: str, html_body: str, text_body: str | None = None,
+               recipients: list[str] | None = None):
+    if recipients is None:
+        recipients = [e.strip() for e in TO_EMAIL.split(",") if e.strip()]
+
     msg = MIMEMultipart("alternative")
     msg["From"] = SMTP_USER
-    recipients = [e.strip() for e in TO_EMAIL.split(",") if e.strip()]
     msg["To"] = ", ".join(recipients)
 
     msg["Subject"] = subject
@@ -388,39 +583,43 @@ def send_email(subject: str, html_body: str, text_body: str | None = None):
     msg.attach(part1)
     msg.attach(part2)
 
-    with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-        server.starttls()
-        server.login(SMTP_USER, SMTP_PASSWORD)
-        server.sendmail(SMTP_USER, recipients, msg.as_string())
+    server.sendmail(SMTP_USER, recipients, msg.as_string())
 
 
 
 # ====== MAIN ======
 
-def main():
-    # Build today's full report (partial + full in stock + full OOS)
-    report = build_report_via_products_json()
-    html_body = format_report_html(report)
-    text_body = format_report_text(report)
+def main() -> None:
+    # Build today's full report (partial + full in stock + full OOS);
+    # the state fingerprints come out of the same pass over the products.
+    report, curr_state = build_report_via_products_json()
 
-    # Build simple state from report
-    curr_state = extract_state_from_report(report)
+    # Diff against the last run first, so the (common) no-change path
+    # never renders the HTML/text bodies.
     prev_state = load_previous_state()
 
-    changed = has_changes(prev_state, curr_state)
-    print(f"State changed since last run: {changed}")
+    added, removed, changed = diff_states(prev_state, curr_state)
+    state_changed = bool(added or removed or changed)
+    logger.info(
+        "State changed since last run: %s (%d added, %d removed, %d changed)",
+        state_changed, len(added), len(removed), len(changed),
+    )
 
     # Save current state for next run (always)
     save_current_state(curr_state)
 
     # Decide whether to email
-    if ONLY_EMAIL_IF_CHANGES and not changed:
-        print("No change in availability since last run; not sending email.")
+    if ONLY_EMAIL_IF_CHANGES and not state_changed:
+        logger.info("No change in availability since last run; not sending email.")
         return
 
+    html_body = format_report_html(report)
+    text_body = format_report_text(report)
+
     subject = "CAVA Daily Stock Report (Full Inventory View)"
-    send_email(subject, html_body, text_body)
-    print("Email sent.")
+    with open_smtp() as server:
+        send_email(server, subject, html_body, text_body)
+    logger.info("Email sent.")
 
 
 if __name__ == "__main__":